@@ -2,15 +2,16 @@ import os
 import numpy as np
 import imageio.v3
 import json
+import tempfile
 import time
 import torch
+from concurrent.futures import ThreadPoolExecutor
 import torch.nn as nn
 import torch.nn.functional as F
 import lpips
 
 
 from torch.utils.tensorboard import SummaryWriter
-from skimage.metrics import structural_similarity as ssim
 from tqdm import tqdm, trange
 
 import matplotlib.pyplot as plt
@@ -23,54 +24,106 @@ from load_blender import load_blender_data
 from load_LINEMOD import load_LINEMOD_data
 
 
-loss_fn_lpips = lpips.LPIPS(net="vgg")  # best forward scores
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+loss_fn_lpips = lpips.LPIPS(net="vgg").to(device).eval()  # best forward scores
 np.random.seed(0)
 DEBUG = False
 
+# Sample positions along a ray in [0, 1], keyed by (N_samples, device, dtype)
+t_vals_cache = {}
+
+
+def to_device(array, dtype=torch.float32):
+    """Uploads a host array to 'device' without an intermediate tensor copy.
+
+    The one-time upload is not staged in pinned memory: the caching host
+    allocator would keep a page-locked block as large as the array for the rest
+    of the run.
+    """
+    tensor = torch.from_numpy(np.ascontiguousarray(array, dtype=np.float32))
+    return tensor.to(device, dtype=dtype)
+
+
+def prefetch_rays(rays_rgb, idx, host_buf, dev_buf, copy_stream, copy_done):
+    """Gathers host rays_rgb[idx] into pinned host_buf and copies it to dev_buf.
+
+    The copy is issued on copy_stream and the returned device batch is only valid
+    once the consuming stream waits on copy_stream. copy_done is recorded after the
+    copy so host_buf is not overwritten while the transfer is still in flight.
+    """
+    n = idx.shape[0]
+    copy_done.synchronize()
+    torch.index_select(rays_rgb, 0, idx, out=host_buf[:n])
+    # dev_buf may still be read by work already queued on the compute stream
+    copy_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(copy_stream):
+        dev_buf[:n].copy_(host_buf[:n], non_blocking=True)
+    copy_done.record(copy_stream)
+    return dev_buf[:n]
+
 
 def batchify(fn, chunk):
-    """Constructs a version of 'fn' that applies to smaller batches."""
+    """Constructs a version of 'fn' that applies to smaller batches.
+
+    Any extra inputs are sliced along their first dimension alongside 'inputs'.
+    """
     if chunk is None:
         return fn
 
-    def ret(inputs):
-        return torch.cat(
-            [fn(inputs[i : i + chunk]) for i in range(0, inputs.shape[0], chunk)], 0
-        )
+    def ret(inputs, *extra_inputs):
+        if inputs.shape[0] <= chunk:
+            return fn(inputs, *extra_inputs)
+
+        # Write every chunk straight into one preallocated output instead of
+        # keeping all chunks alive until a final torch.cat.
+        first = fn(inputs[:chunk], *[x[:chunk] for x in extra_inputs])
+        outputs = first.new_empty((inputs.shape[0],) + first.shape[1:])
+        outputs[:chunk] = first
+        for i in range(chunk, inputs.shape[0], chunk):
+            outputs[i : i + chunk] = fn(
+                inputs[i : i + chunk], *[x[i : i + chunk] for x in extra_inputs]
+            )
+        return outputs
 
     return ret
 
 
 def run_network(inputs, viewdirs, fn, embed_fn, embeddirs_fn, netchunk=1024 * 64):
     """Prepares inputs and applies network 'fn'."""
-    inputs_flat = torch.reshape(inputs, [-1, inputs.shape[-1]])
+    inputs_flat = inputs.view(-1, inputs.shape[-1])
     embedded = embed_fn(inputs_flat)
 
-    if viewdirs is not None:
-        input_dirs = viewdirs[:, None].expand(inputs.shape)
-        input_dirs_flat = torch.reshape(input_dirs, [-1, input_dirs.shape[-1]])
-        embedded_dirs = embeddirs_fn(input_dirs_flat)
-        embedded = torch.cat([embedded, embedded_dirs], -1)
-
-    outputs_flat = batchify(fn, netchunk)(embedded)
-    outputs = torch.reshape(
-        outputs_flat, list(inputs.shape[:-1]) + [outputs_flat.shape[-1]]
-    )
+    if viewdirs is None:
+        outputs_flat = batchify(fn, netchunk)(embedded)
+    else:
+        # Embed each ray direction once. Every chunk gathers the embedding of
+        # its points' rays and hands it to the network separately, which only
+        # concatenates it after the density head.
+        embedded_dirs = embeddirs_fn(viewdirs)  # [N_rays, input_ch_views]
+        ray_index = torch.arange(inputs.shape[0], device=inputs.device)
+        ray_index = ray_index.repeat_interleave(inputs.shape[1])  # [N_rays * N_samples]
+        fn_views = lambda pts, ray_idx: fn(pts, embedded_dirs[ray_idx])
+        outputs_flat = batchify(fn_views, netchunk)(embedded, ray_index)
+
+    outputs = outputs_flat.view(list(inputs.shape[:-1]) + [outputs_flat.shape[-1]])
     return outputs
 
 
 def batchify_rays(rays_flat, chunk=1024 * 32, **kwargs):
     """Render rays in smaller minibatches to avoid OOM."""
+    N_rays = rays_flat.shape[0]
+    if N_rays <= chunk:
+        return render_rays(rays_flat, **kwargs)
+
+    # Outputs are allocated once from the first chunk and filled in place
     all_ret = {}
-    for i in range(0, rays_flat.shape[0], chunk):
+    for i in range(0, N_rays, chunk):
         ret = render_rays(rays_flat[i : i + chunk], **kwargs)
         for k in ret:
             if k not in all_ret:
-                all_ret[k] = []
-            all_ret[k].append(ret[k])
+                all_ret[k] = ret[k].new_empty((N_rays,) + ret[k].shape[1:])
+            all_ret[k][i : i + chunk].copy_(ret[k], non_blocking=True)
 
-    all_ret = {k: torch.cat(all_ret[k], 0) for k in all_ret}
     return all_ret
 
 
@@ -99,8 +152,8 @@ def render(
         each example in batch.
       c2w: array of shape [3, 4]. Camera-to-world transformation matrix.
       ndc: bool. If True, represent ray origin, direction in NDC coordinates.
-      near: float or array of shape [batch_size]. Nearest distance for a ray.
-      far: float or array of shape [batch_size]. Farthest distance for a ray.
+      near: float. Nearest distance for a ray.
+      far: float. Farthest distance for a ray.
       use_viewdirs: bool. If True, use viewing direction of a point in space in model.
       c2w_staticcam: array of shape [3, 4]. If not None, use this transformation matrix for
        camera while using other c2w argument for viewing directions.
@@ -123,7 +176,7 @@ def render(
         if c2w_staticcam is not None:
             # special case to visualize effect of viewdirs
             rays_o, rays_d = get_rays(H, W, K, c2w_staticcam)
-        viewdirs = viewdirs / torch.norm(viewdirs, dim=-1, keepdim=True)
+        viewdirs = viewdirs / torch.linalg.vector_norm(viewdirs, dim=-1, keepdim=True)
         viewdirs = torch.reshape(viewdirs, [-1, 3]).float()
 
     sh = rays_d.shape  # [..., 3]
@@ -135,18 +188,24 @@ def render(
     rays_o = torch.reshape(rays_o, [-1, 3]).float()
     rays_d = torch.reshape(rays_d, [-1, 3]).float()
 
-    near, far = near * torch.ones_like(rays_d[..., :1]), far * torch.ones_like(
-        rays_d[..., :1]
+    # [ro+rd+near+far(+viewdirs)], filled in place instead of concatenated
+    rays = torch.empty(
+        (rays_d.shape[0], 11 if use_viewdirs else 8),
+        dtype=torch.float32,
+        device=rays_d.device,
     )
-    rays = torch.cat([rays_o, rays_d, near, far], -1)
+    rays[:, 0:3].copy_(rays_o)
+    rays[:, 3:6].copy_(rays_d)
+    rays[:, 6].fill_(near)
+    rays[:, 7].fill_(far)
     if use_viewdirs:
-        rays = torch.cat([rays, viewdirs], -1)
+        rays[:, 8:11].copy_(viewdirs)
 
     # Render and reshape
     all_ret = batchify_rays(rays, chunk, **kwargs)
     for k in all_ret:
         k_sh = list(sh[:-1]) + list(all_ret[k].shape[1:])
-        all_ret[k] = torch.reshape(all_ret[k], k_sh)
+        all_ret[k] = all_ret[k].view(k_sh)
 
     k_extract = ["rgb_map", "disp_map", "acc_map", "depth_map"]
     ret_list = [all_ret[k] for k in k_extract]
@@ -154,9 +213,19 @@ def render(
     return ret_list + [ret_dict]
 
 
-def normalize_negative_one(img):
-    normalized_input = (img - np.amin(img)) / (np.amax(img) - np.amin(img))
-    return 2 * normalized_input - 1
+def write_frame(filename_rgb, filename_depth, rgb, depth, copied=None):
+    """Saves a rendered frame and its colorized depth map as PNGs.
+
+    'copied' is an optional CUDA event to wait for before reading rgb/depth,
+    when they were copied to the host with non_blocking=True. rgb is already
+    quantized to uint8. Returns the colorized depth map [3, H, W].
+    """
+    if copied is not None:
+        copied.synchronize()
+    depth = visualize_depth(depth).numpy()
+    imageio.v3.imwrite(filename_rgb, rgb.numpy())
+    imageio.v3.imwrite(filename_depth, to8b(depth.transpose(1, 2, 0)))
+    return depth
 
 
 def render_path(
@@ -169,6 +238,7 @@ def render_path(
     savedir=None,
     render_factor=0,
     mask=[],
+    bf16=False,
 ):
     H, W, fx, fy = hwf
     if render_factor != 0:
@@ -178,79 +248,148 @@ def render_path(
         fx = fx / render_factor
         fy = fy / render_factor
 
-    rgbs = []
-    disps = []
-    depths = []
+    # Frames are copied asynchronously to (pinned) host buffers as they finish,
+    # so device memory does not grow with the number of poses. rgb is quantized
+    # to uint8 on the device first, which moves a quarter of the bytes.
+    pin = device.type == "cuda"
+    rgbs = torch.empty((len(render_poses), H, W, 3), dtype=torch.uint8, pin_memory=pin)
+    disps = torch.empty((len(render_poses), H, W), pin_memory=pin)
+    depths = torch.empty((len(render_poses), H, W), pin_memory=pin)
 
     psnrs_scores = []
     psnrs_unmasked_scores = []
     ssims_scores = []
     lpips_scores = []
-
-    t = time.time()
-    for i, c2w in enumerate(tqdm(render_poses)):
-        print(i, time.time() - t)
+    rgbs_metric = []
+    gts_metric = []
+
+    compute_metrics = gt_imgs is not None and render_factor == 0
+    copy_stream = None
+    if compute_metrics and not torch.is_tensor(gt_imgs) and device.type == "cuda":
+        # Host ground truth is staged one frame at a time through a reusable
+        # pinned buffer, so its upload overlaps with rendering the frame
+        gt_staging = torch.empty(np.shape(gt_imgs[0]), pin_memory=True)
+        gt_copied = torch.cuda.Event()
+        copy_stream = torch.cuda.Stream()
+
+    if len(mask) != 0:
+        # All masks are the same, so move the first one to the device once
+        first_mask = torch.as_tensor(mask[0], dtype=torch.float32, device=device)
+        valid_mask = (first_mask != 0).expand(-1, -1, 3)
+
+    if bf16 and device.type == "cuda" and not torch.cuda.is_bf16_supported():
+        print("bfloat16 is not supported on this GPU, rendering in float32")
+        bf16 = False
+    if bf16:
+        # Only the MLP query runs under bfloat16 autocast; ray generation, sampling
+        # and compositing stay in float32
+        network_query_fn = render_kwargs["network_query_fn"]
+
+        def network_query_bf16(*args, **kwargs):
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16):
+                return network_query_fn(*args, **kwargs).float()
+
+        render_kwargs = dict(render_kwargs, network_query_fn=network_query_bf16)
+
+    # PNG encoding runs in the background while the next frame renders. Leaving
+    # the with block waits for pending writes, also when rendering raises.
+    writes = []
+    with ThreadPoolExecutor(max_workers=2) as write_pool:
         t = time.time()
-        rgb, disp, acc, depth, _ = render(
-            H, W, K, chunk=chunk, c2w=c2w[:3, :4], **render_kwargs
-        )
-
-        if len(mask) != 0:
-            # All masks are the same
-            first_mask = mask[0]
-            rgb_masked = rgb.cpu().numpy() * first_mask
-
-        rgbs.append(rgb.cpu().numpy())
-        disps.append(disp.cpu().numpy())
-        depth = visualize_depth(depth)
-        depths.append(depth.cpu().numpy())
-
-        if i == 0:
-            print(rgb.shape, disp.shape, depth.shape)
-
-        if gt_imgs is not None and render_factor == 0:
-            gt_img = (
-                gt_imgs[i].cpu().numpy() if torch.is_tensor(gt_imgs[i]) else gt_imgs[i]
-            )
-            rgb_img = rgb_masked if len(mask) else rgb.cpu().numpy()
-
-            p = -10.0 * np.log10(np.mean(np.square(rgb_img - gt_img)))
-            
-            if len(mask) != 0:
-                # remove mask from psnr calculation
-                valid_mask = np.repeat(mask[0] != 0, 3, axis=2)
-                psnr_unmasked = np.square(rgb_img - gt_img)[valid_mask]
-                psnr_unmasked = -10.0 * np.log10(np.mean(psnr_unmasked))
-            ssim_score = ssim(rgb_img, gt_img, channel_axis=2, data_range=1.0)
-
-            # LPIPS require images in -1 to 1 range.
-            rgb_lpips = lpips.im2tensor(normalize_negative_one(rgb_img))
-            gt_lpips = lpips.im2tensor(normalize_negative_one(gt_img))
+        for i, c2w in enumerate(tqdm(render_poses)):
+            print(i, time.time() - t)
+            t = time.time()
+            if compute_metrics:
+                if copy_stream is not None:
+                    gt_copied.synchronize()  # the previous upload has left gt_staging
+                    gt_staging.copy_(
+                        torch.from_numpy(np.asarray(gt_imgs[i], np.float32))
+                    )
+                    with torch.cuda.stream(copy_stream):
+                        gt_gpu = gt_staging.to(device, non_blocking=True)
+                    gt_copied.record(copy_stream)
+                else:
+                    gt_gpu = torch.as_tensor(
+                        gt_imgs[i], dtype=torch.float32, device=device
+                    )
 
-            rgb_lpips = rgb_lpips.to("cpu")
-            gt_lpips = gt_lpips.to("cpu")
+            # Rendering here is forward only
+            with torch.inference_mode():
+                rgb, disp, acc, depth, _ = render(
+                    H, W, K, chunk=chunk, c2w=c2w[:3, :4], **render_kwargs
+                )
 
-            lpips_score = loss_fn_lpips(rgb_lpips, gt_lpips)
+            rgbs[i].copy_(to8b_gpu(rgb), non_blocking=True)
+            disps[i].copy_(disp, non_blocking=True)
+            depths[i].copy_(depth, non_blocking=True)
+
+            if i == 0:
+                print(rgb.shape, disp.shape, depth.shape)
+
+            if compute_metrics:
+                # Metrics are computed for all frames at once after the loop
+                if copy_stream is not None:
+                    torch.cuda.current_stream().wait_stream(copy_stream)
+                    gt_gpu.record_stream(torch.cuda.current_stream())
+                rgbs_metric.append(rgb * first_mask if len(mask) else rgb)
+                gts_metric.append(gt_gpu)
+
+            if savedir is not None:
+                # The writer waits for the copy event before reading the frame
+                copied = None
+                if device.type == "cuda":
+                    copied = torch.cuda.Event()
+                    copied.record()
+                filename_rgb = os.path.join(savedir, "{:03d}.png".format(i))
+                filename_depth = os.path.join(savedir, "{:03d}_depth.png".format(i))
+                writes.append(
+                    write_pool.submit(
+                        write_frame,
+                        filename_rgb,
+                        filename_depth,
+                        rgbs[i],
+                        depths[i],
+                        copied,
+                    )
+                )
 
-            ssims_scores.append(ssim_score)
-            psnrs_scores.append(p)
-            lpips_scores.append(lpips_score.item())
+    # Also re-raises any error from the writer threads
+    depth_maps = [write.result() for write in writes]
+    if device.type == "cuda":
+        torch.cuda.current_stream().synchronize()  # all frame copies have landed
 
-            print("PSNR: ", p)
-            print("SSIM: ", ssim_score)
-            print("LPIPS: ", lpips_score.item())
+    if rgbs_metric:
+        rgbs_metric = torch.stack(rgbs_metric, 0)  # [N, H, W, 3]
+        gts_metric = torch.stack(gts_metric, 0)  # [N, H, W, 3]
 
-            if len(mask) != 0:
-                psnrs_unmasked_scores.append(psnr_unmasked)
-                print("PSNR UNMASKED: ", psnr_unmasked)
+        sq_err = torch.square(rgbs_metric - gts_metric)
+        psnrs_scores = (-10.0 * torch.log10(sq_err.mean(dim=(1, 2, 3)))).tolist()
+        if len(mask) != 0:
+            # remove mask from psnr calculation
+            psnrs_unmasked_scores = (
+                -10.0 * torch.log10(sq_err[:, valid_mask].mean(-1))
+            ).tolist()
+
+        window = ssim_window(device=device)
+        metric_batch = 8
+        for j in range(0, rgbs_metric.shape[0], metric_batch):
+            rgb_batch = rgbs_metric[j : j + metric_batch].permute(0, 3, 1, 2)
+            gt_batch = gts_metric[j : j + metric_batch].permute(0, 3, 1, 2)
+            ssims_scores += ssim_pt(rgb_batch, gt_batch, window).tolist()
+
+            # LPIPS require images in -1 to 1 range, [B, 3, H, W] on the model's device.
+            # Both images are already in [0, 1], so no min/max rescale is needed.
+            rgb_lpips = rgb_batch.clamp(0, 1).mul(2).sub_(1)
+            gt_lpips = gt_batch.clamp(0, 1).mul(2).sub_(1)
+            with torch.no_grad():
+                lpips_scores += loss_fn_lpips(rgb_lpips, gt_lpips).flatten().tolist()
 
-        if savedir is not None:
-            rgb8 = to8b(rgbs[-1])
-            depth8 = to8b(depths[-1].transpose(1, 2, 0))
-            filename_rgb = os.path.join(savedir, "{:03d}.png".format(i))
-            filename_depth = os.path.join(savedir, "{:03d}_depth.png".format(i))
-            imageio.v3.imwrite(filename_rgb, rgb8)
-            imageio.v3.imwrite(filename_depth, depth8)
+        for i in range(len(psnrs_scores)):
+            print(f"[{i}] PSNR: ", psnrs_scores[i])
+            print(f"[{i}] SSIM: ", ssims_scores[i])
+            print(f"[{i}] LPIPS: ", lpips_scores[i])
+            if psnrs_unmasked_scores:
+                print(f"[{i}] PSNR UNMASKED: ", psnrs_unmasked_scores[i])
 
     if psnrs_unmasked_scores:
         psnr_unmasked_score = round(float(np.mean(psnrs_unmasked_scores)), 2)
@@ -301,11 +440,11 @@ def render_path(
             with open(os.path.join(savedir, "results.json"), "w") as file:
                 file.write(json_object)
 
-    rgbs = np.stack(rgbs, 0)
-    disps = np.stack(disps, 0)
-    depths = np.stack(depths, 0)
+    if not depth_maps:
+        depth_maps = [visualize_depth(depth).numpy() for depth in depths]
+    depths = np.stack(depth_maps, 0)
 
-    return rgbs, disps, depths
+    return rgbs.numpy(), disps.numpy(), depths
 
 
 def create_nerf(args):
@@ -374,11 +513,8 @@ def create_nerf(args):
     if args.ft_path is not None and args.ft_path != "None":
         ckpts = [args.ft_path]
     else:
-        ckpts = [
-            os.path.join(basedir, expname, f)
-            for f in sorted(os.listdir(os.path.join(basedir, expname)))
-            if "tar" in f
-        ]
+        with os.scandir(os.path.join(basedir, expname)) as entries:
+            ckpts = sorted(entry.path for entry in entries if "tar" in entry.name)
 
     print("Found ckpts", ckpts)
     if len(ckpts) > 0 and not args.no_reload:
@@ -421,12 +557,15 @@ def create_nerf(args):
     return render_kwargs_train, render_kwargs_test, start, grad_vars, optimizer
 
 
-def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=False):
+@maybe_compile()
+def raw2outputs(
+    raw, z_vals, rays_d_norm, raw_noise_std=0, white_bkgd=False, pytest=False
+):
     """Transforms model's predictions to semantically meaningful values.
     Args:
         raw: [num_rays, num_samples along ray, 4]. Prediction from model.
         z_vals: [num_rays, num_samples along ray]. Integration time.
-        rays_d: [num_rays, 3]. Direction of each ray.
+        rays_d_norm: [num_rays, 1]. Length of each ray direction.
     Returns:
         rgb_map: [num_rays, 3]. Estimated RGB color of a ray.
         disp_map: [num_rays]. Disparity map. Inverse of depth map.
@@ -438,37 +577,33 @@ def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=F
 
     dists = z_vals[..., 1:] - z_vals[..., :-1]
     dists = torch.cat(
-        [dists, torch.Tensor([1e10]).expand(dists[..., :1].shape)], -1
+        [dists, torch.full_like(dists[..., :1], 1e10)], -1
     )  # [N_rays, N_samples]
 
-    dists = dists * torch.norm(rays_d[..., None, :], dim=-1)
+    dists = dists * rays_d_norm
 
     rgb = torch.sigmoid(raw[..., :3])  # [N_rays, N_samples, 3]
     noise = 0.0
     if raw_noise_std > 0.0:
-        noise = torch.randn(raw[..., 3].shape) * raw_noise_std
+        noise = torch.randn_like(raw[..., 3]) * raw_noise_std
 
         # Overwrite randomly sampled data if pytest
         if pytest:
             np.random.seed(0)
             noise = np.random.rand(*list(raw[..., 3].shape)) * raw_noise_std
-            noise = torch.Tensor(noise)
+            noise = torch.tensor(noise, dtype=raw.dtype, device=raw.device)
 
     alpha = raw2alpha(raw[..., 3] + noise, dists)  # [N_rays, N_samples]
     # weights = alpha * tf.math.cumprod(1.-alpha + 1e-10, -1, exclusive=True)
-    weights = (
-        alpha
-        * torch.cumprod(
-            torch.cat([torch.ones((alpha.shape[0], 1)), 1.0 - alpha + 1e-10], -1), -1
-        )[:, :-1]
-    )
+    # Exclusive cumprod: shift the inclusive one right and start every ray at 1
+    transmittance = torch.cumprod(1.0 - alpha + 1e-10, -1)
+    transmittance = F.pad(transmittance[..., :-1], (1, 0), value=1.0)
+    weights = alpha * transmittance
     rgb_map = torch.sum(weights[..., None] * rgb, -2)  # [N_rays, 3]
 
     depth_map = torch.sum(weights * z_vals, -1)
-    disp_map = 1.0 / torch.max(
-        1e-10 * torch.ones_like(depth_map), depth_map / torch.sum(weights, -1)
-    )
     acc_map = torch.sum(weights, -1)
+    disp_map = acc_map / torch.clamp(depth_map, min=1e-10)
 
     if white_bkgd:
         rgb_map = rgb_map + (1.0 - acc_map[..., None])
@@ -523,11 +658,18 @@ def render_rays(
     """
     N_rays = ray_batch.shape[0]
     rays_o, rays_d = ray_batch[:, 0:3], ray_batch[:, 3:6]  # [N_rays, 3] each
+    # Shared by the coarse and fine passes of raw2outputs
+    rays_d_norm = torch.linalg.vector_norm(rays_d, dim=-1, keepdim=True)  # [N_rays, 1]
     viewdirs = ray_batch[:, -3:] if ray_batch.shape[-1] > 8 else None
-    bounds = torch.reshape(ray_batch[..., 6:8], [-1, 1, 2])
+    bounds = ray_batch[..., 6:8].view(-1, 1, 2)
     near, far = bounds[..., 0], bounds[..., 1]  # [-1,1]
 
-    t_vals = torch.linspace(0.0, 1.0, steps=N_samples)
+    t_vals_key = (N_samples, near.device, near.dtype)
+    if t_vals_key not in t_vals_cache:
+        t_vals_cache[t_vals_key] = torch.linspace(
+            0.0, 1.0, steps=N_samples, device=near.device, dtype=near.dtype
+        )
+    t_vals = t_vals_cache[t_vals_key]
     if not lindisp:
         z_vals = near * (1.0 - t_vals) + far * (t_vals)
     else:
@@ -541,24 +683,24 @@ def render_rays(
         upper = torch.cat([mids, z_vals[..., -1:]], -1)
         lower = torch.cat([z_vals[..., :1], mids], -1)
         # stratified samples in those intervals
-        t_rand = torch.rand(z_vals.shape)
+        t_rand = torch.rand(z_vals.shape, device=z_vals.device, dtype=z_vals.dtype)
 
         # Pytest, overwrite u with numpy's fixed random numbers
         if pytest:
             np.random.seed(0)
             t_rand = np.random.rand(*list(z_vals.shape))
-            t_rand = torch.Tensor(t_rand)
+            t_rand = torch.tensor(t_rand, dtype=z_vals.dtype, device=z_vals.device)
 
         z_vals = lower + (upper - lower) * t_rand
 
-    pts = (
-        rays_o[..., None, :] + rays_d[..., None, :] * z_vals[..., :, None]
+    pts = torch.addcmul(
+        rays_o[..., None, :], rays_d[..., None, :], z_vals[..., :, None]
     )  # [N_rays, N_samples, 3]
 
     #     raw = run_network(pts)
     raw = network_query_fn(pts, viewdirs, network_fn)
     rgb_map, disp_map, acc_map, weights, depth_map = raw2outputs(
-        raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest
+        raw, z_vals, rays_d_norm, raw_noise_std, white_bkgd, pytest=pytest
     )
 
     if N_importance > 0:
@@ -575,8 +717,8 @@ def render_rays(
         z_samples = z_samples.detach()
 
         z_vals, _ = torch.sort(torch.cat([z_vals, z_samples], -1), -1)
-        pts = (
-            rays_o[..., None, :] + rays_d[..., None, :] * z_vals[..., :, None]
+        pts = torch.addcmul(
+            rays_o[..., None, :], rays_d[..., None, :], z_vals[..., :, None]
         )  # [N_rays, N_samples + N_importance, 3]
 
         run_fn = network_fn if network_fine is None else network_fine
@@ -584,7 +726,7 @@ def render_rays(
         raw = network_query_fn(pts, viewdirs, run_fn)
 
         rgb_map, disp_map, acc_map, weights, depth_map = raw2outputs(
-            raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest
+            raw, z_vals, rays_d_norm, raw_noise_std, white_bkgd, pytest=pytest
         )
 
     ret = {"rgb_map": rgb_map, "disp_map": disp_map, "acc_map": acc_map, "depth_map": depth_map}
@@ -597,13 +739,44 @@ def render_rays(
         ret["depth0"] = depth_map_0
         ret["z_std"] = torch.std(z_samples, dim=-1, unbiased=False)  # [N_rays]
 
-    for k in ret:
-        if (torch.isnan(ret[k]).any() or torch.isinf(ret[k]).any()) and DEBUG:
-            print(f"! [Numerical Error] {k} contains nan or inf.")
+    if DEBUG:
+        for k in ret:
+            if torch.isnan(ret[k]).any() or torch.isinf(ret[k]).any():
+                print(f"! [Numerical Error] {k} contains nan or inf.")
 
     return ret
 
 
+@maybe_compile()
+def compute_losses(rgb, target_s, rgb0=None, batch_mask=None):
+    """Training loss and PSNRs of a ray batch.
+    Returns:
+      loss, psnr, psnr0, psnr_unmasked, psnr0_unmasked. The coarse (rgb0) and
+      unmasked values are None when there is no coarse output or no mask.
+    """
+    # Fine and coarse predictions share one squared-error buffer and reduction
+    preds = rgb[None] if rgb0 is None else torch.stack([rgb, rgb0], 0)
+    if batch_mask is not None:
+        preds = preds * batch_mask
+    sq_err = torch.square(preds - target_s)  # [1 or 2, N_rand, 3]
+
+    mses = sq_err.mean(dim=(1, 2))
+    loss = mses.sum()
+    psnrs = mse2psnr(mses)
+    psnr = psnrs[0]
+    psnr0 = psnrs[1] if rgb0 is not None else None
+
+    psnr_unmasked = psnr0_unmasked = None
+    if batch_mask is not None:
+        # Mean over pixels inside the mask only, without a boolean gather
+        valid = (batch_mask != 0).to(sq_err.dtype)
+        psnrs_unmasked = mse2psnr((sq_err * valid).sum(dim=(1, 2)) / valid.sum())
+        psnr_unmasked = psnrs_unmasked[0]
+        psnr0_unmasked = psnrs_unmasked[1] if rgb0 is not None else None
+
+    return loss, psnr, psnr0, psnr_unmasked, psnr0_unmasked
+
+
 def config_parser():
     import configargparse
 
@@ -661,6 +834,18 @@ def config_parser():
         action="store_true",
         help="only take random rays from 1 image at a time",
     )
+    parser.add_argument(
+        "--half_rays",
+        action="store_true",
+        help="keep the random ray batch buffer in float16 to halve its memory and bandwidth. "
+        "Ray origins and directions are rounded too (about 1e-3 relative), which can "
+        "shift training rays by up to a pixel at typical resolutions",
+    )
+    parser.add_argument(
+        "--rays_on_host",
+        action="store_true",
+        help="keep the random ray batch in host memory and prefetch batches to the GPU, for datasets that do not fit in VRAM",
+    )
     parser.add_argument(
         "--no_reload", action="store_true", help="do not reload weights from saved ckpt"
     )
@@ -734,6 +919,11 @@ def config_parser():
     parser.add_argument(
         "--render_spiral", action="store_true", help="render a spiral video"
     )
+    parser.add_argument(
+        "--render_bf16",
+        action="store_true",
+        help="run the MLP under bfloat16 autocast when rendering test views and videos, faster but slightly changes reported metrics",
+    )
 
     # training options
     parser.add_argument(
@@ -889,20 +1079,18 @@ def train():
                 i_test = np.arange(images.shape[0])[:: args.llffhold]
 
             # i_val = i_test
-            i_train = np.array(
-                [
-                    i
-                    for i in np.arange(int(images.shape[0]))
-                    if (i not in i_test and i not in i_val)
-                ]
+            i_train = np.setdiff1d(
+                np.arange(images.shape[0]),
+                np.union1d(np.asarray(i_test), np.asarray(i_val)),
+                assume_unique=True,
             )
         else:
-            i_train = np.array([i for i in np.arange(int(images.shape[0]))])
+            i_train = np.arange(images.shape[0])
 
         print("DEFINING BOUNDS")
         if args.no_ndc:
-            near = np.ndarray.min(bds) * 0.9
-            far = np.ndarray.max(bds) * 1.0
+            bmin, bmax = bds.min(), bds.max()
+            near, far = bmin * 0.9, bmax * 1.0
 
         else:
             near = 0.0
@@ -997,6 +1185,13 @@ def train():
     )
     global_step = start
 
+    # Learning rate decays by decay_rate every decay_steps, one step per iteration
+    decay_rate = 0.1
+    decay_steps = args.lrate_decay * 1000
+    scheduler = torch.optim.lr_scheduler.ExponentialLR(
+        optimizer, gamma=decay_rate ** (1.0 / decay_steps)
+    )
+
     bds_dict = {
         "near": near,
         "far": far,
@@ -1005,7 +1200,7 @@ def train():
     render_kwargs_test.update(bds_dict)
 
     # Move testing data to GPU
-    render_poses = torch.Tensor(render_poses).to(device)
+    render_poses = to_device(render_poses)
 
     # Short circuit if only rendering out from trained model
     if args.render_only:
@@ -1046,10 +1241,11 @@ def train():
                 savedir=testsavedir,
                 render_factor=args.render_factor,
                 mask=mask,
+                bf16=args.render_bf16,
             )
             print("Done rendering", testsavedir)
             imageio.v3.imwrite(
-                os.path.join(testsavedir, "video.mp4"), to8b(rgbs), fps=30, quality=8
+                os.path.join(testsavedir, "video.mp4"), rgbs, fps=30, quality=8
             )
             imageio.v3.imwrite(
                 os.path.join(testsavedir, "video_depth.mp4"), to8b(depths.transpose(0,2,3,1)), fps=30, quality=8
@@ -1060,45 +1256,86 @@ def train():
     # Prepare raybatch tensor if batching random rays
     N_rand = args.N_rand
     use_batching = not args.no_batching
+    rays_on_host = use_batching and args.rays_on_host and device.type == "cuda"
     if use_batching:
         # For random ray batching
-        print("get rays")
-        rays = np.stack(
-            [get_rays_np(H, W, K, p) for p in poses[:, :3, :4]], 0
-        )  # [N, ro+rd, H, W, 3]
-        print("done, concats")
-
-        if mask_exists:
-            expanded_mask = np.repeat(mask[:, None], 3, axis=4)
-            rays_rgb = np.concatenate(
-                [rays, images[:, None], expanded_mask], 1
-            )  # [N, ro+rd+rgb+mask, H, W, 3]
+        # Write rays, colors and mask straight into their final
+        # [N_train, H, W, ro+rd+rgb/ro+rd+rgb+mask, 3] layout
+        rays_shape = (len(i_train), H, W, 4 if mask_exists else 3, 3)
+        rays_dtype = torch.float16 if args.half_rays else torch.float32
+        if rays_on_host:
+            # Back the host-resident batch by an anonymous temp file so the page
+            # cache, not the process heap, holds rays that do not fit in RAM.
+            # It lives next to the checkpoints because /tmp is often RAM-backed,
+            # and is created in its final dtype so it is never copied afterwards.
+            rays_rgb = np.memmap(
+                tempfile.TemporaryFile(dir=os.path.join(basedir, expname)),
+                dtype=np.float16 if args.half_rays else np.float32,
+                mode="w+",
+                shape=rays_shape,
+            )
         else:
-            rays_rgb = np.concatenate(
-                [rays, images[:, None]], 1
-            )  # [N, ro+rd+rgb, H, W, 3]
-        rays_rgb = np.transpose(
-            rays_rgb, [0, 2, 3, 1, 4]
-        )  # [N, H, W, ro+rd+rgb/ro+rd+rgb+mask, 3]
-        rays_rgb = np.stack([rays_rgb[i] for i in i_train], 0)  # train images only
-        rays_rgb = (
-            np.reshape(rays_rgb, [-1, 4, 3])
-            if mask_exists
-            else np.reshape(rays_rgb, [-1, 3, 3])
-        )  # [(N-1)*H*W, ro+rd+rgb/ro+rd+rgb+mask, 3]
-        rays_rgb = rays_rgb.astype(np.float32)
-        print("shuffle rays")
-        np.random.shuffle(rays_rgb)
+            rays_rgb = np.empty(rays_shape, dtype=np.float32)
 
+        print("get rays")
+        train_poses = torch.from_numpy(
+            np.asarray(poses[i_train, :3, :4], np.float32)
+        ).to(device)
+        # With --rays_on_host the ray batch may not fit in VRAM or RAM, so it is
+        # filled one pose at a time instead of for all train poses at once
+        pose_group = 1 if rays_on_host else len(i_train)
+        for j in range(0, len(i_train), pose_group):
+            group = slice(j, j + pose_group)
+            rays = get_rays_batched(
+                H, W, K, train_poses[group]
+            ).cpu().numpy()  # [pose_group, ro+rd, H, W, 3]
+            rays_rgb[group, ..., 0, :] = rays[:, 0]
+            rays_rgb[group, ..., 1, :] = rays[:, 1]
+            del rays
+            rays_rgb[group, ..., 2, :] = images[i_train[group]]
+            if mask_exists:
+                # [pose_group, H, W, 1] broadcast to 3
+                rays_rgb[group, ..., 3, :] = mask[i_train[group]]
+        rays_rgb = rays_rgb.reshape(
+            -1, 4 if mask_exists else 3, 3
+        )  # [(N-1)*H*W, ro+rd+rgb/ro+rd+rgb+mask, 3]
         print("done")
         i_batch = 0
 
     # Move training data to GPU
     if use_batching:
-        images = torch.Tensor(images).to(device)
-    poses = torch.Tensor(poses).to(device)
+        images = to_device(images)
+    poses = to_device(poses)
     if use_batching:
-        rays_rgb = torch.Tensor(rays_rgb).to(device)
+        if rays_on_host:
+            # Only N_rand rows at a time are gathered from the memmap by prefetch_rays
+            rays_rgb = torch.from_numpy(rays_rgb)
+        else:
+            rays_rgb = to_device(rays_rgb, dtype=rays_dtype)
+        # Rays are shuffled through a permutation instead of being moved in memory
+        rays_perm = torch.randperm(rays_rgb.shape[0], device=rays_rgb.device)
+
+    if rays_on_host:
+        # Double buffering: batch i + 1 is gathered and copied on a side stream
+        # while step i runs on the default stream
+        copy_stream = torch.cuda.Stream()
+        batch_shape = (N_rand,) + rays_rgb.shape[1:]
+        host_bufs = [
+            torch.empty(batch_shape, dtype=rays_dtype).pin_memory() for _ in range(2)
+        ]
+        dev_bufs = [
+            torch.empty(batch_shape, dtype=rays_dtype, device=device) for _ in range(2)
+        ]
+        copies_done = [torch.cuda.Event(), torch.cuda.Event()]
+        slot = 0
+        next_batch = prefetch_rays(
+            rays_rgb,
+            rays_perm[:N_rand],
+            host_bufs[slot],
+            dev_bufs[slot],
+            copy_stream,
+            copies_done[slot],
+        )
 
     N_iters = 200000 + 1
     print("Begin")
@@ -1110,30 +1347,57 @@ def train():
 
     # get last version number and increment
     version_num = "0"
-    os.makedirs(os.path.join(basedir,expname, "summaries"), exist_ok=True)
-    if os.path.isdir(os.path.join(basedir, expname, "summaries")):
+    summaries_dir = os.path.join(basedir, expname, "summaries")
+    os.makedirs(summaries_dir, exist_ok=True)
+    # DirEntry.is_dir() reuses the type returned by the listing instead of a stat per run
+    with os.scandir(summaries_dir) as entries:
         version_list = sorted(
-            [
-                int(item.split("_")[-1])
-                for item in os.listdir(os.path.join(basedir, expname, "summaries"))
-                if os.path.isdir(os.path.join(basedir, expname, "summaries", item))
-            ]
+            int(entry.name.rsplit("_", 1)[-1]) for entry in entries if entry.is_dir()
         )
-        version_num = str(version_list[-1] + 1) if version_list else "0"
+    version_num = str(version_list[-1] + 1) if version_list else "0"
 
-    log_dir = os.path.join(basedir, expname, "summaries", f"{expname}_{version_num}")
+    log_dir = os.path.join(summaries_dir, f"{expname}_{version_num}")
     writer = SummaryWriter(log_dir)
     print(f"Saving logs to {log_dir}")
 
+    if len(i_test) > 0:
+        # Gathered once; poses (and images when batching) already live on the device
+        i_test_t = torch.as_tensor(i_test, dtype=torch.long, device=device)
+        poses_test = poses.index_select(0, i_test_t).contiguous()
+        images_test = images[i_test]
+
     start = start + 1
+
+    if not use_batching:
+        # Pixel coordinates to sample rays from, with and without center cropping
+        dH = int(H // 2 * args.precrop_frac)
+        dW = int(W // 2 * args.precrop_frac)
+        coords_precrop = torch.cartesian_prod(
+            torch.arange(H // 2 - dH, H // 2 + dH, device=device),
+            torch.arange(W // 2 - dW, W // 2 + dW, device=device),
+        )  # (2dH * 2dW, 2)
+        coords_full = torch.cartesian_prod(
+            torch.arange(H, device=device), torch.arange(W, device=device)
+        )  # (H * W, 2)
+        if start < args.precrop_iters:
+            print(
+                f"[Config] Center cropping of size {2*dH} x {2*dW} is enabled until iter {args.precrop_iters}"
+            )
+
     for i in trange(start, N_iters):
         time0 = time.time()
 
         # Sample random ray batch
         if use_batching:
             # Random over all images
-            batch = rays_rgb[i_batch : i_batch + N_rand]  # [B, 2+1, 3*?]
-            batch = torch.transpose(batch, 0, 1)
+            if rays_on_host:
+                torch.cuda.current_stream().wait_stream(copy_stream)
+                batch = next_batch
+            else:
+                batch = rays_rgb.index_select(
+                    0, rays_perm[i_batch : i_batch + N_rand]
+                )  # [B, 2+1, 3*?]
+            batch = torch.transpose(batch.float(), 0, 1)
             if mask_exists:
                 batch_rays, target_s, batch_mask = batch[:2], batch[2], batch[3]
             else:
@@ -1142,10 +1406,20 @@ def train():
             i_batch += N_rand
             if i_batch >= rays_rgb.shape[0]:
                 print("Shuffle data after an epoch!")
-                rand_idx = torch.randperm(rays_rgb.shape[0])
-                rays_rgb = rays_rgb[rand_idx]
+                rays_perm = torch.randperm(rays_rgb.shape[0], device=rays_rgb.device)
                 i_batch = 0
 
+            if rays_on_host:
+                slot = 1 - slot
+                next_batch = prefetch_rays(
+                    rays_rgb,
+                    rays_perm[i_batch : i_batch + N_rand],
+                    host_bufs[slot],
+                    dev_bufs[slot],
+                    copy_stream,
+                    copies_done[slot],
+                )
+
         else:
             # Random from one image
             img_i = np.random.choice(i_train)
@@ -1154,37 +1428,13 @@ def train():
             pose = poses[img_i, :3, :4]
 
             if N_rand is not None:
-                rays_o, rays_d = get_rays(
-                    H, W, K, torch.Tensor(pose)
-                )  # (H, W, 3), (H, W, 3)
-
-                if i < args.precrop_iters:
-                    dH = int(H // 2 * args.precrop_frac)
-                    dW = int(W // 2 * args.precrop_frac)
-                    coords = torch.stack(
-                        torch.meshgrid(
-                            torch.linspace(H // 2 - dH, H // 2 + dH - 1, 2 * dH),
-                            torch.linspace(W // 2 - dW, W // 2 + dW - 1, 2 * dW),
-                        ),
-                        -1,
-                    )
-                    if i == start:
-                        print(
-                            f"[Config] Center cropping of size {2*dH} x {2*dW} is enabled until iter {args.precrop_iters}"
-                        )
-                else:
-                    coords = torch.stack(
-                        torch.meshgrid(
-                            torch.linspace(0, H - 1, H), torch.linspace(0, W - 1, W)
-                        ),
-                        -1,
-                    )  # (H, W, 2)
-
-                coords = torch.reshape(coords, [-1, 2])  # (H * W, 2)
-                select_inds = np.random.choice(
-                    coords.shape[0], size=[N_rand], replace=False
-                )  # (N_rand,)
-                select_coords = coords[select_inds].long()  # (N_rand, 2)
+                rays_o, rays_d = get_rays(H, W, K, pose)  # (H, W, 3), (H, W, 3)
+
+                coords = coords_precrop if i < args.precrop_iters else coords_full
+                select_inds = torch.randperm(coords.shape[0], device=coords.device)[
+                    :N_rand
+                ]  # (N_rand,)
+                select_coords = coords[select_inds]  # (N_rand, 2)
                 rays_o = rays_o[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
                 rays_d = rays_d[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
                 batch_rays = torch.stack([rays_o, rays_d], 0)
@@ -1200,50 +1450,22 @@ def train():
             chunk=args.chunk,
             rays=batch_rays,
             verbose=i < 10,
-            retraw=True,
             **render_kwargs_train,
         )
 
-        if mask_exists:
-            rgb = rgb * batch_mask
-
         optimizer.zero_grad()
-        img_loss = img2mse(rgb, target_s)
-
-        trans = extras["raw"][..., -1]
-        loss = img_loss
-        psnr = mse2psnr(img_loss)
-
-        if "rgb0" in extras:
-            img_loss0 = (
-                img2mse(extras["rgb0"] * batch_mask, target_s)
-                if mask_exists
-                else img2mse(extras["rgb0"], target_s)
-            )
-            loss = loss + img_loss0
-            psnr0 = mse2psnr(img_loss0)
-
-        if mask_exists:
-            img_loss_unmasked = img2mse(rgb, target_s, batch_mask != 0)
-            psnr_unmasked = mse2psnr(img_loss_unmasked)
-
-            if "rgb0" in extras:
-                img_loss0_unmasked = (
-                    img2mse(extras["rgb0"] * batch_mask, target_s, batch_mask != 0)
-                    if mask_exists
-                    else img2mse(extras["rgb0"], target_s, batch_mask != 0)
-                )
-                psnr0_unmasked = mse2psnr(img_loss0_unmasked)
+        loss, psnr, psnr0, psnr_unmasked, psnr0_unmasked = compute_losses(
+            rgb,
+            target_s,
+            rgb0=extras.get("rgb0"),
+            batch_mask=batch_mask if mask_exists else None,
+        )
         loss.backward()
         optimizer.step()
 
         # NOTE: IMPORTANT!
         ###   update learning rate   ###
-        decay_rate = 0.1
-        decay_steps = args.lrate_decay * 1000
-        new_lrate = args.lrate * (decay_rate ** (global_step / decay_steps))
-        for param_group in optimizer.param_groups:
-            param_group["lr"] = new_lrate
+        scheduler.step()
         ################################
 
         dt = time.time() - time0
@@ -1270,7 +1492,13 @@ def train():
             mask = mask if mask_exists else []
             with torch.no_grad():
                 rgbs, disps, depths = render_path(
-                    render_poses, hwf, K, args.chunk, render_kwargs_test, mask=mask
+                    render_poses,
+                    hwf,
+                    K,
+                    args.chunk,
+                    render_kwargs_test,
+                    mask=mask,
+                    bf16=args.render_bf16,
                 )
             print("Done, saving", rgbs.shape, disps.shape, depths.shape)
             movie_name = (
@@ -1280,29 +1508,30 @@ def train():
             )
 
             moviebase = os.path.join(basedir, expname, movie_name)
-            imageio.v2.mimwrite(moviebase + "rgb.mp4", to8b(rgbs), fps=30, quality=8)
+            imageio.v2.mimwrite(moviebase + "rgb.mp4", rgbs, fps=30, quality=8)
             imageio.v2.mimwrite(moviebase + "depth.mp4", to8b(depths.transpose(0,2,3,1)), fps=30, quality=8)
             imageio.v2.mimwrite(
                 moviebase + "disp.mp4", to8b(disps / np.max(disps)), fps=30, quality=8
             )
             print(f"Saved {moviebase}rgb.mp4 and {moviebase}disp.mp4.")
 
-        if i_test and i % args.i_testset == 0 and i > 0:
+        if len(i_test) > 0 and i % args.i_testset == 0 and i > 0:
             testsavedir = os.path.join(basedir, expname, "testset_{:06d}".format(i))
             os.makedirs(testsavedir, exist_ok=True)
             mask = mask if mask_exists else []
 
-            print("test poses shape", poses[i_test].shape)
+            print("test poses shape", poses_test.shape)
             with torch.no_grad():
                 render_path(
-                    torch.Tensor(poses[i_test]).to(device),
+                    poses_test,
                     hwf,
                     K,
                     args.chunk,
                     render_kwargs_test,
-                    gt_imgs=images[i_test],
+                    gt_imgs=images_test,
                     savedir=testsavedir,
                     mask=mask,
+                    bf16=args.render_bf16,
                 )
             print("Saved test set")
 
@@ -1350,7 +1579,8 @@ def train():
                 depth = visualize_depth(depth)
                 writer.add_images("val/depth", torch.stack([depth]),i)
                 if mask_exists:
-                    rgb_masked = rgb * torch.tensor(mask[0])
+                    rgb_mask = torch.tensor(mask[0], dtype=rgb.dtype, device=rgb.device)
+                    rgb_masked = rgb * rgb_mask
                     psnr_val = mse2psnr(img2mse(rgb_masked, target))
 
                     # Add stack of gt, masked rendered image, rendered image
@@ -1364,7 +1594,7 @@ def train():
 
                     writer.add_images("val/gt_rgb(masked)_rgb", stack, i)
                     if args.N_importance > 0:
-                        rgb0_masked = extras["rgb0"] * torch.tensor(mask[0])
+                        rgb0_masked = extras["rgb0"] * rgb_mask
                         psnr0_val = mse2psnr(img2mse(rgb0_masked, target))
 
                         # Add stack of fine network rendered image
@@ -1407,6 +1637,4 @@ def train():
 
 
 if __name__ == "__main__":
-    torch.set_default_tensor_type("torch.cuda.FloatTensor")
-
     train()
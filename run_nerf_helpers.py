@@ -10,9 +10,44 @@ from PIL import Image
 
 
 # Misc
-img2mse = lambda x, y, mask=None : torch.mean((x - y) ** 2) if mask is None else torch.mean(((x - y) ** 2)[mask])
-mse2psnr = lambda x : -10. * torch.log(x) / torch.log(torch.Tensor([10.]))
+img2mse = lambda x, y : torch.mean((x - y) ** 2)
+mse2psnr = lambda x : -10. * torch.log10(x)
 to8b = lambda x : (255*np.clip(x,0,1)).astype(np.uint8)
+to8b_gpu = lambda x : (255*x.clamp(0,1)).to(torch.uint8)
+
+
+def ssim_window(win_size=7, channels=3, device=None):
+    """Uniform [channels, 1, win_size, win_size] window, skimage's default for SSIM."""
+    return torch.full((channels, 1, win_size, win_size), 1. / win_size**2, device=device)
+
+
+def ssim_pt(x, y, window, data_range=1.):
+    """SSIM per image for [B, C, H, W] tensors, matching skimage's structural_similarity.
+
+    Like skimage, borders the window does not fully cover are left out of the mean.
+    """
+    filt = lambda img : F.conv2d(img, window, groups=x.shape[1])
+    n_px = window.shape[-2] * window.shape[-1]
+    cov_norm = n_px / (n_px - 1)  # sample covariance
+
+    ux, uy = filt(x), filt(y)
+    vx = cov_norm * (filt(x * x) - ux * ux)
+    vy = cov_norm * (filt(y * y) - uy * uy)
+    vxy = cov_norm * (filt(x * y) - ux * uy)
+
+    C1 = (0.01 * data_range) ** 2
+    C2 = (0.03 * data_range) ** 2
+    S = ((2 * ux * uy + C1) * (2 * vxy + C2)) / ((ux ** 2 + uy ** 2 + C1) * (vx + vy + C2))
+    return S.mean(dim=(1, 2, 3))
+
+
+def maybe_compile(**compile_kwargs):
+    """Decorator that applies torch.compile when it is available (PyTorch >= 2.0)."""
+    def decorator(fn):
+        if hasattr(torch, 'compile'):
+            return torch.compile(fn, **compile_kwargs)
+        return fn
+    return decorator
 
 
 # Positional encoding (section 5.1)
@@ -97,8 +132,12 @@ class NeRF(nn.Module):
         else:
             self.output_linear = nn.Linear(W, output_ch)
 
-    def forward(self, x):
-        input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
+    def forward(self, x, input_views=None):
+        # View directions are either concatenated to x or passed separately
+        if input_views is None:
+            input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
+        else:
+            input_pts = x
         h = input_pts
         for i, l in enumerate(self.pts_linears):
             h = self.pts_linears[i](h)
@@ -155,12 +194,16 @@ class NeRF(nn.Module):
 
 # Ray helpers
 def get_rays(H, W, K, c2w):
-    i, j = torch.meshgrid(torch.linspace(0, W-1, W), torch.linspace(0, H-1, H))  # pytorch's meshgrid has indexing='ij'
+    i, j = torch.meshgrid(torch.linspace(0, W-1, W, device=c2w.device),
+                          torch.linspace(0, H-1, H, device=c2w.device), indexing='ij')
     i = i.t()
     j = j.t()
     dirs = torch.stack([(i-K[0][2])/K[0][0], -(j-K[1][2])/K[1][1], -torch.ones_like(i)], -1)
     # Rotate ray directions from camera frame to the world frame
-    rays_d = torch.sum(dirs[..., np.newaxis, :] * c2w[:3,:3], -1)  # dot product, equals to: [c2w.dot(dir) for dir in dirs]
+    # equals to: [c2w.dot(dir) for dir in dirs], as three elementwise terms rather than a matmul
+    # so it stays in float32 under autocast/TF32 and needs no [H, W, 3, 3] temporary
+    R = c2w[:3,:3]
+    rays_d = dirs[...,0:1]*R[:,0] + dirs[...,1:2]*R[:,1] + dirs[...,2:3]*R[:,2]
     # Translate camera frame's origin to the world frame. It is the origin of all rays.
     rays_o = c2w[:3,-1].expand(rays_d.shape)
     return rays_o, rays_d
@@ -176,6 +219,20 @@ def get_rays_np(H, W, K, c2w):
     return rays_o, rays_d
 
 
+def get_rays_batched(H, W, K, poses):
+    """Rays for all camera poses [N, 3, 4] at once, returned as [N, ro+rd, H, W, 3]."""
+    i, j = torch.meshgrid(torch.arange(W, dtype=poses.dtype, device=poses.device),
+                          torch.arange(H, dtype=poses.dtype, device=poses.device), indexing='xy')
+    dirs = torch.stack([(i-K[0][2])/K[0][0], -(j-K[1][2])/K[1][1], -torch.ones_like(i)], -1)
+    # Rotate ray directions from camera frame to the world frame for every pose,
+    # elementwise as in get_rays so the result stays in float32
+    R = poses[:, None, None, :3, :3]  # [N, 1, 1, 3, 3]
+    rays_d = dirs[...,0:1]*R[...,0] + dirs[...,1:2]*R[...,1] + dirs[...,2:3]*R[...,2]
+    # Translate camera frame's origin to the world frame. It is the origin of all rays.
+    rays_o = poses[:, None, None, :3, -1].expand(rays_d.shape)
+    return torch.stack([rays_o, rays_d], 1)
+
+
 def ndc_rays(H, W, focal, near, rays_o, rays_d):
     # Shift ray origins to near plane
     t = -(near + rays_o[...,2]) / rays_d[...,2]
@@ -206,10 +263,10 @@ def sample_pdf(bins, weights, N_samples, det=False, pytest=False):
 
     # Take uniform samples
     if det:
-        u = torch.linspace(0., 1., steps=N_samples)
+        u = torch.linspace(0., 1., steps=N_samples, device=cdf.device, dtype=cdf.dtype)
         u = u.expand(list(cdf.shape[:-1]) + [N_samples])
     else:
-        u = torch.rand(list(cdf.shape[:-1]) + [N_samples])
+        u = torch.rand(list(cdf.shape[:-1]) + [N_samples], device=cdf.device, dtype=cdf.dtype)
 
     # Pytest, overwrite u with numpy's fixed random numbers
     if pytest:
@@ -220,7 +277,7 @@ def sample_pdf(bins, weights, N_samples, det=False, pytest=False):
             u = np.broadcast_to(u, new_shape)
         else:
             u = np.random.rand(*new_shape)
-        u = torch.Tensor(u)
+        u = torch.tensor(u, dtype=cdf.dtype, device=cdf.device)
 
     # Invert CDF
     u = u.contiguous()